@@ -1,12 +1,25 @@
+import hashlib
 import logging
 import os
+import random
+import time
 from typing import Dict, Optional
 import asyncio
 import json
 import re
+from io import BytesIO
 
 import gspread
+import httpx
 from google.oauth2.service_account import Credentials
+from openai import AsyncOpenAI
+
+# orjson - швидший C-парсер JSON; за відсутності падаємо назад на стандартний json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
@@ -22,23 +35,279 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 GOOGLE_CREDENTIALS_JSON = os.getenv('GOOGLE_CREDENTIALS_JSON')  # JSON як рядок
 GOOGLE_SHEET_URL = os.getenv('GOOGLE_SHEET_URL')
+PUBLIC_URL = os.getenv('PUBLIC_URL')  # Зовнішня адреса сервісу для webhook
 PORT = int(os.getenv('PORT', 8080))
+SHEETS_REFRESH_SECONDS = int(os.getenv('SHEETS_REFRESH_SECONDS', 300))
+
+SHEETS_SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.readonly"
+]
+
+# Парсимо credentials один раз при старті процесу
+GOOGLE_CREDENTIALS = (
+    Credentials.from_service_account_info(_json_loads(GOOGLE_CREDENTIALS_JSON), scopes=SHEETS_SCOPE)
+    if GOOGLE_CREDENTIALS_JSON else None
+)
 
 # Глобальні змінні
 openai_client = None
-user_states: Dict[int, str] = {}
+
+# Скільки найкращих кандидатів надсилаємо до OpenAI
+SHORTLIST_SIZE = 5
+
+# Обмеження одночасних запитів до OpenAI та параметри circuit breaker
+OPENAI_MAX_CONCURRENCY = 20
+BREAKER_FAIL_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+
+# Ключові слова для конкретних страв
+FOOD_KEYWORDS = {
+    'піца': ['піц', 'pizza'],
+    'паста': ['паст', 'спагеті', 'pasta'],
+    'бургер': ['бургер', 'burger', 'гамбургер'],
+    'суші': ['суш', 'sushi', 'рол'],
+    'салат': ['салат', 'salad'],
+    'хумус': ['хумус', 'hummus'],
+    'фалафель': ['фалафель', 'falafel'],
+    'шаурма': ['шаурм', 'shawarma'],
+    'стейк': ['стейк', 'steak', 'мясо'],
+    'риба': ['риб', 'fish', 'лосось'],
+    'курка': ['курк', 'курич', 'chicken'],
+    'десерт': ['десерт', 'торт', 'тірамісу', 'морозиво']
+}
+
+# Прекомпільовані регулярки: одна альтернація на страву замість вкладених циклів по ключових словах.
+# Використовуються і для запиту користувача, і для тексту меню (ключові слова однакові)
+FOOD_PATTERNS = {
+    dish: re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+    for dish, keywords in FOOD_KEYWORDS.items()
+}
+
+# Прекомпільована регулярка для ID файлу в Google Drive посиланні
+_DRIVE_FILE_RE = re.compile(r'/file/d/([a-zA-Z0-9-_]+)')
+
+# Прекомпільована регулярка для номера варіанту у відповіді OpenAI
+_DIGITS_RE = re.compile(r'\d+')
+
+# Біт кожної страви для масок меню, щоб фільтр був побітовим AND замість сканування тексту
+DISH_BITS = {dish: 1 << i for i, dish in enumerate(FOOD_KEYWORDS)}
+
+# Ключові слова для різних категорій: (слова в запиті користувача, слова в описі закладу)
+CATEGORY_KEYWORDS = {
+    'romantic': (['романт', 'побачен', 'двох', 'інтимн', 'затишн'], ['інтимн', 'романт', 'для пар', 'затишн']),
+    'family': (['сім', 'діт', 'родин', 'батьк'], ['сімейн', 'діт', 'родин']),
+    'business': (['діл', 'зустріч', 'перегов', 'бізнес'], ['діл', 'зустріч', 'бізнес']),
+    'friends': (['друз', 'компан', 'гуртом', 'весел'], ['компан', 'друз', 'молодіжн']),
+    'quick': (['швидк', 'перекус', 'фаст', 'поспіша'], ['швидк', 'casual', 'фаст']),
+    'celebration': (['святкув', 'день народж', 'ювіле', 'свято'], ['святков', 'простор', 'груп'])
+}
+
+CATEGORY_BITS = {category: 1 << i for i, category in enumerate(CATEGORY_KEYWORDS)}
+
+USER_CATEGORY_PATTERNS = {
+    category: re.compile("|".join(map(re.escape, user_kws)), re.IGNORECASE)
+    for category, (user_kws, _) in CATEGORY_KEYWORDS.items()
+}
+
+RESTAURANT_CATEGORY_PATTERNS = {
+    category: re.compile("|".join(map(re.escape, rest_kws)), re.IGNORECASE)
+    for category, (_, rest_kws) in CATEGORY_KEYWORDS.items()
+}
+
+# pyahocorasick - один прохід автомата по рядку замість окремого регекс-скану
+# на кожну страву/категорію; за відсутності лишаємось на прекомпільованих регулярках
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+def _build_automaton(tagged_keywords):
+    """Будує автомат Aho-Corasick; tagged_keywords: {тег: [корені слів]}"""
+    words = {}
+    for tag, roots in tagged_keywords.items():
+        for root in roots:
+            words.setdefault(root.lower(), []).append(tag)
+    automaton = ahocorasick.Automaton()
+    for word, tags in words.items():
+        automaton.add_word(word, tags)
+    automaton.make_automaton()
+    return automaton
+
+if ahocorasick is not None:
+    # Запит користувача класифікуємо одним проходом і по стравах, і по категоріях
+    USER_AUTOMATON = _build_automaton({
+        **{('dish', dish): keywords for dish, keywords in FOOD_KEYWORDS.items()},
+        **{('category', cat): user_kws for cat, (user_kws, _) in CATEGORY_KEYWORDS.items()}
+    })
+    MENU_AUTOMATON = _build_automaton(
+        {('dish', dish): keywords for dish, keywords in FOOD_KEYWORDS.items()}
+    )
+    RESTAURANT_AUTOMATON = _build_automaton(
+        {('category', cat): rest_kws for cat, (_, rest_kws) in CATEGORY_KEYWORDS.items()}
+    )
+else:
+    USER_AUTOMATON = MENU_AUTOMATON = RESTAURANT_AUTOMATON = None
+
+def _scan_masks(automaton, text: str):
+    """(маска страв, маска категорій) за один прохід автомата по тексту"""
+    dish_mask = 0
+    category_mask = 0
+    for _, tags in automaton.iter(text.lower()):
+        for kind, name in tags:
+            if kind == 'dish':
+                dish_mask |= DISH_BITS[name]
+            else:
+                category_mask |= CATEGORY_BITS[name]
+    return dish_mask, category_mask
+
+def _user_masks(text: str):
+    """(маска страв, маска категорій) для запиту користувача"""
+    if USER_AUTOMATON is not None:
+        return _scan_masks(USER_AUTOMATON, text)
+    dish_mask = 0
+    for dish, pattern in FOOD_PATTERNS.items():
+        if pattern.search(text):
+            dish_mask |= DISH_BITS[dish]
+    category_mask = 0
+    for category, pattern in USER_CATEGORY_PATTERNS.items():
+        if pattern.search(text):
+            category_mask |= CATEGORY_BITS[category]
+    return dish_mask, category_mask
+
+def _menu_mask(menu_text: str) -> int:
+    """Маска страв у тексті меню закладу"""
+    if MENU_AUTOMATON is not None:
+        return _scan_masks(MENU_AUTOMATON, menu_text)[0]
+    mask = 0
+    for dish, pattern in FOOD_PATTERNS.items():
+        if pattern.search(menu_text):
+            mask |= DISH_BITS[dish]
+    return mask
+
+def _restaurant_category_mask(search_text: str) -> int:
+    """Маска категорій в описі закладу"""
+    if RESTAURANT_AUTOMATON is not None:
+        return _scan_masks(RESTAURANT_AUTOMATON, search_text)[1]
+    mask = 0
+    for category, pattern in RESTAURANT_CATEGORY_PATTERNS.items():
+        if pattern.search(search_text):
+            mask |= CATEGORY_BITS[category]
+    return mask
+
+# Статичні шаблони промпту та відповіді - форматуємо готовий скелет замість
+# перебудови багаторядкових f-рядків на кожен запит
+_DETAIL_TMPL = """Варіант {i}:
+- Назва: {name}
+- Кухня: {cuisine}
+- Атмосфера: {vibe}
+- Підходить для: {aim}"""
+
+_PROMPT_TMPL = """ЗАПИТ: "{user_request}"
+
+ВАРІАНТИ ЗАКЛАДІВ:
+{restaurants_text}
+
+ПРАВИЛА ВИБОРУ:
+- Уважно проаналізуй запит на ключові слова
+- {example_1}
+- {example_2}
+- НЕ завжди обирай перший варіант
+- Розглядай ВСІ варіанти перед вибором
+
+Поверни номер найкращого варіанту (1-{n})"""
+
+_RESPONSE_TMPL = """🏠 <b>{name}</b>
+
+📍 <b>Адреса:</b> {address}
+
+📱 <b>Соц-мережі:</b> {socials}
+
+✨ <b>Атмосфера:</b> {vibe}"""
+
+class LLMCache:
+    """Простий TTL-кеш для відповідей OpenAI (ключ → назва закладу)"""
+    def __init__(self, maxsize: int = 512, ttl: int = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._store: Dict[str, tuple] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._store[key]
+            return None
+        return value
+
+    def set(self, key: str, value: str):
+        if len(self._store) >= self.maxsize:
+            # Викидаємо найстаріші записи, щоб кеш не ріс безмежно
+            oldest = sorted(self._store.items(), key=lambda kv: kv[1][1])
+            for old_key, _ in oldest[:self.maxsize // 4]:
+                del self._store[old_key]
+        self._store[key] = (value, time.monotonic() + self.ttl)
 
 class RestaurantBot:
     def __init__(self):
         self.restaurants_data = []
-    
+        self._data_version = 0
+        self._llm_cache = LLMCache()
+        self._gc = None
+        self._worksheet = None
+        self._refresh_task = None
+        self._photo_cache: Dict[str, bytes] = {}
+        self._openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        self._fail_count = 0
+        self._breaker_opened_at = 0.0
+
+    def _cache_key(self, user_request: str, filtered_restaurants) -> str:
+        """Ключ кешу: нормалізований запит + версія даних + кількість кандидатів"""
+        payload = json.dumps({
+            "q": user_request.lower().strip(),
+            "v": self._data_version,
+            "n": len(filtered_restaurants)
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _breaker_is_open(self) -> bool:
+        """Чи відкритий circuit breaker (серія збоїв OpenAI, період охолодження ще триває)"""
+        return (self._fail_count >= BREAKER_FAIL_THRESHOLD
+                and time.monotonic() - self._breaker_opened_at < BREAKER_RESET_SECONDS)
+
+    def _record_openai_failure(self):
+        """Фіксує збій OpenAI; після серії збоїв відкриває circuit breaker"""
+        self._fail_count += 1
+        if self._fail_count >= BREAKER_FAIL_THRESHOLD:
+            self._breaker_opened_at = time.monotonic()
+            logger.warning(
+                f"⛔ {self._fail_count} збоїв OpenAI поспіль, "
+                f"відповідаю локально наступні {BREAKER_RESET_SECONDS}с"
+            )
+
+    def _restaurant_to_response(self, restaurant: Dict) -> Dict:
+        """Формує словник рекомендації з запису закладу"""
+        return {
+            "name": restaurant.get('name', 'Ресторан'),
+            "address": restaurant.get('address', 'Адреса не вказана'),
+            "socials": restaurant.get('socials', 'Соц-мережі не вказані'),
+            "vibe": restaurant.get('vibe', 'Приємна атмосфера'),
+            "aim": restaurant.get('aim', 'Для будь-яких подій'),
+            "cuisine": restaurant.get('cuisine', 'Смачна кухня'),
+            "menu": restaurant.get('menu', ''),
+            "menu_url": restaurant.get('menu_url', ''),
+            "photo": restaurant.get('photo', '')
+        }
+
     def _convert_google_drive_url(self, url: str) -> str:
         """Перетворює Google Drive посилання в пряме посилання для зображення"""
         if not url or 'drive.google.com' not in url:
             return url
         
         # Шукаємо ID файлу в посиланні
-        match = re.search(r'/file/d/([a-zA-Z0-9-_]+)', url)
+        match = _DRIVE_FILE_RE.search(url)
         if match:
             file_id = match.group(1)
             # Перетворюємо в пряме посилання
@@ -48,71 +317,153 @@ class RestaurantBot:
         
         logger.warning(f"⚠️ Не вдалося витягнути ID з Google Drive посилання: {url}")
         return url
-        
+
+    def _preprocess_records(self, records):
+        """Один прохід по закладах при завантаженні: нові записи з масками страв
+        і категорій та перетвореним фото, щоб на запит користувача не виконувати
+        жодних сканувань текстів чи перетворень. Сирі записи gspread не мутуються,
+        тому заміна self.restaurants_data атомарна"""
+        processed = []
+        for r in records:
+            search_text = f"{r.get('vibe', '')} {r.get('aim', '')} {r.get('cuisine', '')}".lower()
+            processed.append({
+                **r,
+                'photo': self._convert_google_drive_url(r.get('photo', '')),
+                '_search_text': search_text,
+                '_menu_mask': _menu_mask(r.get('menu', '')),
+                '_category_mask': _restaurant_category_mask(search_text)
+            })
+        return processed
+
     async def init_google_sheets(self):
         """Ініціалізація підключення до Google Sheets"""
         try:
-            scope = [
-                "https://www.googleapis.com/auth/spreadsheets.readonly",
-                "https://www.googleapis.com/auth/drive.readonly"
-            ]
-            
-            # Створюємо credentials з JSON рядка
-            if GOOGLE_CREDENTIALS_JSON:
-                credentials_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-                creds = Credentials.from_service_account_info(credentials_dict, scopes=scope)
-            else:
+            if GOOGLE_CREDENTIALS is None:
                 raise ValueError("GOOGLE_CREDENTIALS_JSON не встановлено")
-            
-            gc = gspread.authorize(creds)
-            google_sheet = gc.open_by_url(GOOGLE_SHEET_URL)
-            worksheet = google_sheet.sheet1
-            
+
+            # Авторизуємось і відкриваємо таблицю лише один раз, далі перевикористовуємо клієнт
+            if self._worksheet is None:
+                self._gc = gspread.authorize(GOOGLE_CREDENTIALS)
+                google_sheet = self._gc.open_by_url(GOOGLE_SHEET_URL)
+                self._worksheet = google_sheet.sheet1
+
             # Отримання даних з таблиці
-            records = worksheet.get_all_records()
-            self.restaurants_data = records
-            
+            records = await asyncio.to_thread(self._worksheet.get_all_records)
+            self.restaurants_data = self._preprocess_records(records)
+            self._data_version += 1  # Інвалідуємо кеш рекомендацій після перезавантаження
+
             logger.info(f"✅ Завантажено {len(self.restaurants_data)} закладів з Google Sheets")
-            
+
+            await self._prefetch_photos()
+
         except Exception as e:
             logger.error(f"❌ Помилка підключення до Google Sheets: {e}")
-            
+
+    def get_photo_bytes(self, url: str) -> Optional[bytes]:
+        """Повертає закешовані байти фото, якщо вони вже завантажені"""
+        return self._photo_cache.get(url)
+
+    async def _prefetch_photos(self):
+        """Завантажує фото закладів у пам'ять один раз, щоб reply_photo надсилав
+        байти напряму і Telegram не ходив до Google Drive на кожне повідомлення"""
+        current_urls = {
+            r.get('photo', '') for r in self.restaurants_data
+            if r.get('photo', '').startswith('http')
+        }
+        # Прибираємо фото закладів, яких більше немає в таблиці
+        self._photo_cache = {
+            url: content for url, content in self._photo_cache.items()
+            if url in current_urls
+        }
+
+        missing = current_urls - self._photo_cache.keys()
+        if not missing:
+            return
+
+        async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
+            for url in missing:
+                try:
+                    resp = await client.get(url)
+                    if resp.status_code == 200 and resp.content:
+                        self._photo_cache[url] = resp.content
+                    else:
+                        logger.warning(f"⚠️ Фото недоступне ({resp.status_code}): {url}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Не вдалося закешувати фото {url}: {e}")
+
+        logger.info(f"📸 Закешовано {len(self._photo_cache)} фото в пам'яті")
+
+    async def _refresh_loop(self, ttl: int = SHEETS_REFRESH_SECONDS):
+        """Фонове оновлення даних з таблиці, щоб запити користувачів не чекали Google API"""
+        while True:
+            await asyncio.sleep(ttl)
+            try:
+                # Якщо перший init не вдався (наприклад, збій авторизації),
+                # пробуємо підключитися з нуля замість вічних помилок на _worksheet
+                if self._worksheet is None:
+                    await self.init_google_sheets()
+                    continue
+
+                records = await asyncio.to_thread(self._worksheet.get_all_records)
+                self.restaurants_data = self._preprocess_records(records)
+                self._data_version += 1
+                logger.info(f"🔄 Оновлено дані: {len(self.restaurants_data)} закладів")
+                await self._prefetch_photos()
+            except Exception as e:
+                # При збої API продовжуємо працювати зі старими даними
+                logger.warning(f"⚠️ Не вдалося оновити дані з Google Sheets, працюю зі старими: {e}")
+
     async def get_recommendation(self, user_request: str) -> Optional[Dict]:
         """Отримання рекомендації через OpenAI з урахуванням меню"""
         try:
-            # Ініціалізуємо OpenAI клієнт
-            global openai_client
-            if openai_client is None:
-                import openai
-                openai.api_key = OPENAI_API_KEY
-                openai_client = openai
-                logger.info("✅ OpenAI клієнт ініціалізовано")
-            
             if not self.restaurants_data:
                 logger.error("❌ Немає даних про ресторани")
                 return None
-            
-            # РАНДОМІЗУЄМО ПОРЯДОК РЕСТОРАНІВ для різноманітності
-            import random
-            shuffled_restaurants = self.restaurants_data.copy()
-            random.shuffle(shuffled_restaurants)
-            
-            logger.info(f"🎲 Перемішав порядок ресторанів для різноманітності")
-            
-            # Спочатку фільтруємо по меню (якщо користувач шукає конкретну страву)
-            filtered_restaurants = self._filter_by_menu(user_request, shuffled_restaurants)
-            
-            # Детальний промпт з рандомізованим списком
-            restaurants_details = []
-            for i, r in enumerate(filtered_restaurants):
-                detail = f"""Варіант {i+1}:
-- Назва: {r.get('name', 'Без назви')}
-- Кухня: {r.get('cuisine', 'Не вказана')}
-- Атмосфера: {r.get('vibe', 'Не описана')}
-- Підходить для: {r.get('aim', 'Не вказано')}"""
-                restaurants_details.append(detail)
-            
-            restaurants_text = "\n\n".join(restaurants_details)
+
+            # Спочатку фільтруємо по меню (якщо користувач шукає конкретну страву).
+            # Дані лише читаються, тому копія/перемішування всього каталогу не потрібні
+            filtered_restaurants = self._filter_by_menu(user_request, self.restaurants_data)
+
+            # Перевіряємо кеш - однакові запити не повинні йти до OpenAI повторно
+            cache_key = self._cache_key(user_request, filtered_restaurants)
+            cached_name = self._llm_cache.get(cache_key)
+            if cached_name:
+                cached_restaurant = next(
+                    (r for r in filtered_restaurants if r.get('name', '') == cached_name),
+                    None
+                )
+                if cached_restaurant:
+                    logger.info(f"⚡ Кеш-хіт: повертаю {cached_name} без запиту до OpenAI")
+                    return self._restaurant_to_response(cached_restaurant)
+
+            # Якщо кандидатів мало, локальний скоринг справляється сам - OpenAI не потрібен
+            if len(filtered_restaurants) <= SHORTLIST_SIZE:
+                logger.info(f"🎯 Лише {len(filtered_restaurants)} кандидатів, обираю локально без OpenAI")
+                chosen_restaurant = self._smart_fallback_selection(user_request, filtered_restaurants)
+                return self._restaurant_to_response(chosen_restaurant)
+
+            # До OpenAI надсилаємо лише топ-K за локальним скорингом, а не весь каталог.
+            # Перемішуємо лише маленький шортлист (O(K)) для різноманітності порядку в промпті
+            shortlist = self._shortlist(user_request, filtered_restaurants)
+            random.shuffle(shortlist)
+
+            # Під час збоїв OpenAI не змушуємо користувача чекати 20с - одразу обираємо локально
+            if self._breaker_is_open():
+                logger.warning("⛔ Circuit breaker відкритий, обираю локально без OpenAI")
+                chosen_restaurant = self._smart_fallback_selection(user_request, shortlist)
+                return self._restaurant_to_response(chosen_restaurant)
+
+            # Детальний промпт з коротким списком
+            restaurants_text = "\n\n".join(
+                _DETAIL_TMPL.format(
+                    i=i + 1,
+                    name=r.get('name', 'Без назви'),
+                    cuisine=r.get('cuisine', 'Не вказана'),
+                    vibe=r.get('vibe', 'Не описана'),
+                    aim=r.get('aim', 'Не вказано')
+                )
+                for i, r in enumerate(shortlist)
+            )
             
             # Додаємо випадкові приклади для різноманітності
             examples = [
@@ -125,80 +476,70 @@ class RestaurantBot:
             random.shuffle(examples)
             selected_examples = examples[:2]
             
-            prompt = f"""ЗАПИТ: "{user_request}"
-
-ВАРІАНТИ ЗАКЛАДІВ:
-{restaurants_text}
+            prompt = _PROMPT_TMPL.format(
+                user_request=user_request,
+                restaurants_text=restaurants_text,
+                example_1=selected_examples[0],
+                example_2=selected_examples[1],
+                n=len(shortlist)
+            )
 
-ПРАВИЛА ВИБОРУ:
-- Уважно проаналізуй запит на ключові слова
-- {selected_examples[0]}
-- {selected_examples[1]}
-- НЕ завжди обирай перший варіант
-- Розглядай ВСІ варіанти перед вибором
+            logger.info(f"🤖 Надсилаю запит до OpenAI з {len(shortlist)} варіантами...")
+            logger.info(f"🔍 Перші 3 варіанти: {[r.get('name') for r in shortlist[:3]]}")
+            
+            # Виконуємо запит з timeout прямо на event loop, без thread pool.
+            # Семафор обмежує кількість одночасних запитів до OpenAI
+            try:
+                async with self._openai_semaphore:
+                    response = await asyncio.wait_for(
+                        openai_client.chat.completions.create(
+                            model="gpt-3.5-turbo",
+                            messages=[
+                                {"role": "system", "content": "Ти експерт-ресторатор. Обирай варіанти різноманітно, не зациклюй на одному закладі."},
+                                {"role": "user", "content": prompt}
+                            ],
+                            max_tokens=200,
+                            temperature=0.4,
+                            top_p=0.9
+                        ),
+                        timeout=20
+                    )
+            except Exception:
+                # Circuit breaker рахує лише збої самого OpenAI, не локальних шляхів
+                self._record_openai_failure()
+                raise
 
-Поверни номер найкращого варіанту (1-{len(filtered_restaurants)})"""
+            self._fail_count = 0  # Успішна відповідь закриває circuit breaker
 
-            logger.info(f"🤖 Надсилаю запит до OpenAI з {len(filtered_restaurants)} варіантами...")
-            logger.info(f"🔍 Перші 3 варіанти: {[r.get('name') for r in filtered_restaurants[:3]]}")
-            
-            def make_openai_request():
-                return openai_client.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": f"Ти експерт-ресторатор. Обирай варіанти різноманітно, не зациклюй на одному закладі."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=200,
-                    temperature=0.4,
-                    top_p=0.9
-                )
-            
-            # Виконуємо запит з timeout
-            response = await asyncio.wait_for(
-                asyncio.to_thread(make_openai_request),
-                timeout=20
-            )
-            
             choice_text = response.choices[0].message.content.strip()
             logger.info(f"🤖 OpenAI повна відповідь: '{choice_text}'")
             
-            # Покращений парсинг - шукаємо перше число в відповіді
-            import re
-            numbers = re.findall(r'\d+', choice_text)
-            
-            if numbers:
-                choice_num = int(numbers[0]) - 1
-                logger.info(f"🔍 Знайдено число в відповіді: {numbers[0]} → індекс {choice_num}")
-                
-                if 0 <= choice_num < len(filtered_restaurants):
-                    chosen_restaurant = filtered_restaurants[choice_num]
-                    logger.info(f"✅ OpenAI обрав: {chosen_restaurant.get('name', '')} (варіант {choice_num + 1} з {len(filtered_restaurants)})")
+            # Швидкий шлях: модель зазвичай відповідає просто цифрою,
+            # інакше шукаємо перше число в тексті
+            try:
+                choice_num = int(choice_text) - 1
+            except ValueError:
+                match = _DIGITS_RE.search(choice_text)
+                choice_num = int(match.group()) - 1 if match else None
+
+            if choice_num is not None:
+                logger.info(f"🔍 Знайдено число в відповіді: {choice_num + 1} → індекс {choice_num}")
+
+                if 0 <= choice_num < len(shortlist):
+                    chosen_restaurant = shortlist[choice_num]
+                    logger.info(f"✅ OpenAI обрав: {chosen_restaurant.get('name', '')} (варіант {choice_num + 1} з {len(shortlist)})")
+                    # Запам'ятовуємо вибір, щоб повторні запити не ходили до OpenAI
+                    self._llm_cache.set(cache_key, chosen_restaurant.get('name', ''))
                 else:
                     logger.warning(f"⚠️ Число {choice_num + 1} поза межами, використовую резервний алгоритм")
-                    chosen_restaurant = self._smart_fallback_selection(user_request, filtered_restaurants)
+                    chosen_restaurant = self._smart_fallback_selection(user_request, shortlist)
             else:
                 logger.warning(f"⚠️ Не знайдено чисел в відповіді, використовую резервний алгоритм")
-                chosen_restaurant = self._smart_fallback_selection(user_request, filtered_restaurants)
-            
-            # Перетворюємо Google Drive посилання на фото
-            photo_url = chosen_restaurant.get('photo', '')
-            if photo_url:
-                photo_url = self._convert_google_drive_url(photo_url)
-            
-            # Повертаємо результат
-            return {
-                "name": chosen_restaurant.get('name', 'Ресторан'),
-                "address": chosen_restaurant.get('address', 'Адреса не вказана'),
-                "socials": chosen_restaurant.get('socials', 'Соц-мережі не вказані'),
-                "vibe": chosen_restaurant.get('vibe', 'Приємна атмосфера'),
-                "aim": chosen_restaurant.get('aim', 'Для будь-яких подій'),
-                "cuisine": chosen_restaurant.get('cuisine', 'Смачна кухня'),
-                "menu": chosen_restaurant.get('menu', ''),
-                "menu_url": chosen_restaurant.get('menu_url', ''),
-                "photo": photo_url  # Використовуємо перетворене посилання
-            }
+                chosen_restaurant = self._smart_fallback_selection(user_request, shortlist)
             
+            # Повертаємо результат (фото вже перетворене при завантаженні)
+            return self._restaurant_to_response(chosen_restaurant)
+
         except asyncio.TimeoutError:
             logger.error("⏰ Timeout при запиті до OpenAI, використовую резервний алгоритм")
             return self._fallback_selection_dict(user_request)
@@ -208,50 +549,18 @@ class RestaurantBot:
 
     def _filter_by_menu(self, user_request: str, restaurant_list):
         """Фільтрує ресторани по меню (якщо користувач шукає конкретну страву)"""
-        user_lower = user_request.lower()
-        
-        # Ключові слова для конкретних страв
-        food_keywords = {
-            'піца': ['піц', 'pizza'],
-            'паста': ['паст', 'спагеті', 'pasta'],
-            'бургер': ['бургер', 'burger', 'гамбургер'],
-            'суші': ['суш', 'sushi', 'рол'],
-            'салат': ['салат', 'salad'],
-            'хумус': ['хумус', 'hummus'],
-            'фалафель': ['фалафель', 'falafel'],
-            'шаурма': ['шаурм', 'shawarma'],
-            'стейк': ['стейк', 'steak', 'мясо'],
-            'риба': ['риб', 'fish', 'лосось'],
-            'курка': ['курк', 'курич', 'chicken'],
-            'десерт': ['десерт', 'торт', 'тірамісу', 'морозиво']
-        }
-        
-        # Перевіряємо чи користувач шукає конкретну страву
-        requested_dishes = []
-        for dish, keywords in food_keywords.items():
-            if any(keyword in user_lower for keyword in keywords):
-                requested_dishes.append(dish)
-        
-        if requested_dishes:
-            # Фільтруємо ресторани де є потрібні страви
-            filtered_restaurants = []
+        # Перевіряємо чи користувач шукає конкретну страву (один прохід по запиту)
+        user_mask, _ = _user_masks(user_request)
+
+        if user_mask:
+            # Фільтруємо ресторани де є потрібні страви (побітовий AND по масках з _preprocess_records)
+            requested_dishes = [dish for dish in FOOD_KEYWORDS if user_mask & DISH_BITS[dish]]
             logger.info(f"🍽 Користувач шукає конкретні страви: {requested_dishes}")
-            
-            for restaurant in restaurant_list:
-                menu_text = restaurant.get('menu', '').lower()
-                has_requested_dish = False
-                
-                for dish in requested_dishes:
-                    dish_keywords = food_keywords[dish]
-                    if any(keyword in menu_text for keyword in dish_keywords):
-                        has_requested_dish = True
-                        logger.info(f"   ✅ {restaurant.get('name', '')} має {dish}")
-                        break
-                
-                if has_requested_dish:
-                    filtered_restaurants.append(restaurant)
-                else:
-                    logger.info(f"   ❌ {restaurant.get('name', '')} немає потрібних страв")
+
+            filtered_restaurants = [
+                restaurant for restaurant in restaurant_list
+                if restaurant.get('_menu_mask', 0) & user_mask
+            ]
             
             if filtered_restaurants:
                 logger.info(f"📋 Відфільтровано до {len(filtered_restaurants)} закладів з потрібними стравами")
@@ -264,44 +573,34 @@ class RestaurantBot:
             logger.info("🔍 Загальний запит, аналізую всі ресторани")
             return restaurant_list
 
-    def _smart_fallback_selection(self, user_request: str, restaurant_list):
-        """Резервний алгоритм з рандомізацією"""
-        import random
-        
-        user_lower = user_request.lower()
-        
-        # Ключові слова для різних категорій
-        keywords_map = {
-            'romantic': (['романт', 'побачен', 'двох', 'інтимн', 'затишн'], ['інтимн', 'романт', 'для пар', 'затишн']),
-            'family': (['сім', 'діт', 'родин', 'батьк'], ['сімейн', 'діт', 'родин']),
-            'business': (['діл', 'зустріч', 'перегов', 'бізнес'], ['діл', 'зустріч', 'бізнес']),
-            'friends': (['друз', 'компан', 'гуртом', 'весел'], ['компан', 'друз', 'молодіжн']),
-            'quick': (['швидк', 'перекус', 'фаст', 'поспіша'], ['швидк', 'casual', 'фаст']),
-            'celebration': (['святкув', 'день народж', 'ювіле', 'свято'], ['святков', 'простор', 'груп'])
-        }
-        
+    def _score_restaurants(self, user_request: str, restaurant_list):
+        """Оцінює заклади по відповідності запиту, повертає список (очки, заклад)
+        відсортований від найкращого"""
+        # Визначаємо категорії запиту один раз, далі лише побітовий AND по масках закладів
+        _, user_mask = _user_masks(user_request)
+
         # Підраховуємо очки
         scored_restaurants = []
         for restaurant in restaurant_list:
-            score = 0
-            restaurant_text = f"{restaurant.get('vibe', '')} {restaurant.get('aim', '')} {restaurant.get('cuisine', '')}".lower()
-            
-            # Аналізуємо відповідність
-            for category, (user_keywords, restaurant_keywords) in keywords_map.items():
-                user_match = any(keyword in user_lower for keyword in user_keywords)
-                if user_match:
-                    restaurant_match = any(keyword in restaurant_text for keyword in restaurant_keywords)
-                    if restaurant_match:
-                        score += 5
-                    
+            score = 5 * (user_mask & restaurant.get('_category_mask', 0)).bit_count()
+
             # Додаємо випадковий бонус для різноманітності
             score += random.uniform(0, 2)
-            
+
             scored_restaurants.append((score, restaurant))
-        
-        # Сортуємо, але беремо з ТОП-3 випадково
+
         scored_restaurants.sort(key=lambda x: x[0], reverse=True)
-        
+        return scored_restaurants
+
+    def _shortlist(self, user_request: str, restaurant_list, k: int = SHORTLIST_SIZE):
+        """Топ-K закладів за локальним скорингом - лише вони йдуть до OpenAI"""
+        scored = self._score_restaurants(user_request, restaurant_list)
+        return [restaurant for _, restaurant in scored[:k]]
+
+    def _smart_fallback_selection(self, user_request: str, restaurant_list):
+        """Резервний алгоритм з рандомізацією"""
+        scored_restaurants = self._score_restaurants(user_request, restaurant_list)
+
         if scored_restaurants[0][0] > 0:
             # Якщо є хороші варіанти, беремо один з топ-3 випадково
             top_candidates = scored_restaurants[:min(3, len(scored_restaurants))]
@@ -317,31 +616,15 @@ class RestaurantBot:
     def _fallback_selection_dict(self, user_request: str):
         """Резервний алгоритм що повертає словник"""
         chosen = self._smart_fallback_selection(user_request, self.restaurants_data)
-        
-        # Перетворюємо Google Drive посилання на фото
-        photo_url = chosen.get('photo', '')
-        if photo_url:
-            photo_url = self._convert_google_drive_url(photo_url)
-        
-        return {
-            "name": chosen.get('name', 'Ресторан'),
-            "address": chosen.get('address', 'Адреса не вказана'),
-            "socials": chosen.get('socials', 'Соц-мережі не вказані'),
-            "vibe": chosen.get('vibe', 'Приємна атмосфера'),
-            "aim": chosen.get('aim', 'Для будь-яких подій'),
-            "cuisine": chosen.get('cuisine', 'Смачна кухня'),
-            "menu": chosen.get('menu', ''),
-            "menu_url": chosen.get('menu_url', ''),
-            "photo": photo_url  # Використовуємо перетворене посилання
-        }
+        return self._restaurant_to_response(chosen)
 
 restaurant_bot = RestaurantBot()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обробник команди /start"""
     user_id = update.effective_user.id
-    user_states[user_id] = "waiting_request"
-    
+    context.user_data['state'] = 'waiting_request'
+
     message = (
         "🍽 Привіт! Я допоможу тобі знайти ідеальний ресторан!\n\n"
         "Розкажи мені про своє побажання. Наприклад:\n"
@@ -359,7 +642,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Якщо користувач не використав /start, пропонуємо це зробити
-    if user_id not in user_states:
+    if 'state' not in context.user_data:
         await update.message.reply_text("Напишіть /start, щоб почати")
         return
     
@@ -377,13 +660,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if recommendation:
         # Готуємо основну інформацію
-        response_text = f"""🏠 <b>{recommendation['name']}</b>
-
-📍 <b>Адреса:</b> {recommendation['address']}
-
-📱 <b>Соц-мережі:</b> {recommendation['socials']}
-
-✨ <b>Атмосфера:</b> {recommendation['vibe']}"""
+        response_text = _RESPONSE_TMPL.format(
+            name=recommendation['name'],
+            address=recommendation['address'],
+            socials=recommendation['socials'],
+            vibe=recommendation['vibe']
+        )
 
         # Додаємо ТІЛЬКИ посилання на меню (без тексту меню)
         menu_url = recommendation.get('menu_url', '')
@@ -394,11 +676,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         photo_url = recommendation.get('photo', '')
         
         if photo_url and photo_url.startswith('http'):
-            # Надсилаємо фото як медіафайл з підписом
+            # Надсилаємо фото як медіафайл з підписом: з кешу в пам'яті якщо є,
+            # інакше посиланням (тоді Telegram сам завантажує з Google Drive)
             try:
-                logger.info(f"📸 Спроба надіслати фото: {photo_url}")
+                photo_bytes = restaurant_bot.get_photo_bytes(photo_url)
+                if photo_bytes:
+                    logger.info(f"📸 Надсилаю фото з кешу ({len(photo_bytes)} байт)")
+                    photo = BytesIO(photo_bytes)
+                else:
+                    logger.info(f"📸 Спроба надіслати фото: {photo_url}")
+                    photo = photo_url
                 await update.message.reply_photo(
-                    photo=photo_url,
+                    photo=photo,
                     caption=response_text,
                     parse_mode='HTML'
                 )
@@ -418,14 +707,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Вибачте, не знайшов закладів з потрібними стравами. Спробуйте змінити запит або вказати конкретну страву.")
         logger.warning(f"⚠️ Не знайдено рекомендацій для користувача {user_id}")
     
-    # Прибираємо стан користувача і пропонуємо почати заново
-    del user_states[user_id]
+    # Прибираємо стан користувача і пропонуємо почати заново (pop не кидає KeyError
+    # якщо користувач встиг надіслати два повідомлення поспіль)
+    context.user_data.pop('state', None)
     await update.message.reply_text("Напишіть /start, щоб почати знову")
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Обробник помилок"""
     logger.error(f"❌ Помилка: {context.error}")
 
+async def post_init(application: Application):
+    """Асинхронний старт сервісів на event loop PTB (виконується до прийому оновлень)"""
+    logger.info("🔗 Підключаюся до Google Sheets...")
+    await restaurant_bot.init_google_sheets()
+
+    # Фонове оновлення таблиці, щоб дані не застарівали без ручного перезапуску.
+    # Посилання зберігаємо, щоб задачу не прибрав garbage collector
+    restaurant_bot._refresh_task = asyncio.create_task(restaurant_bot._refresh_loop())
+
+    logger.info("✅ Всі сервіси підключено! Бот готовий до роботи!")
+
 def create_app():
     """Створює та налаштовує Telegram application"""
     if not TELEGRAM_BOT_TOKEN:
@@ -439,33 +740,54 @@ def create_app():
     if not GOOGLE_SHEET_URL:
         logger.error("❌ GOOGLE_SHEET_URL не встановлений!")
         raise ValueError("GOOGLE_SHEET_URL required")
-    
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    
-    # Додаємо обробники
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+    # Один спільний OpenAI клієнт на весь процес - створюємо при старті,
+    # щоб перший користувач не чекав на ініціалізацію модуля
+    global openai_client
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=20, max_retries=2)
+    logger.info("✅ OpenAI клієнт ініціалізовано")
+
+    # Великий keep-alive пул, щоб reply_text/reply_photo не відкривали з'єднання на кожне повідомлення
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connection_pool_size(256)
+        .pool_timeout(5)
+        .connect_timeout(5)
+        .read_timeout(10)
+        .post_init(post_init)
+        .build()
+    )
+
+    # Додаємо обробники (block=False — повільні запити не блокують обробку інших користувачів)
+    application.add_handler(CommandHandler("start", start, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     application.add_error_handler(error_handler)
     
     return application
 
-async def main():
+def main():
     """Основна функція запуску бота"""
     logger.info("🚀 Запускаю оновлений бота...")
-    
+
     try:
         application = create_app()
         logger.info("✅ Telegram додаток створено успішно!")
-        
-        # Ініціалізуємо Google Sheets
-        logger.info("🔗 Підключаюся до Google Sheets...")
-        await restaurant_bot.init_google_sheets()
-        
-        logger.info("✅ Всі сервіси підключено! Бот готовий до роботи!")
-        
-        # Запуск polling
-        await application.run_polling(drop_pending_updates=True)
-        
+
+        # run_webhook/run_polling у PTB 20 синхронні - самі створюють і ведуть event loop.
+        # Webhook якщо задано PUBLIC_URL (Telegram пушить оновлення сам), інакше polling
+        if PUBLIC_URL:
+            logger.info(f"🌐 Запускаю webhook на порту {PORT}")
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TELEGRAM_BOT_TOKEN,
+                webhook_url=f"{PUBLIC_URL}/{TELEGRAM_BOT_TOKEN}",
+                drop_pending_updates=True
+            )
+        else:
+            application.run_polling(drop_pending_updates=True)
+
     except KeyboardInterrupt:
         logger.info("🛑 Бот зупинено користувачем")
     except Exception as e:
@@ -473,4 +795,4 @@ async def main():
         raise
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file